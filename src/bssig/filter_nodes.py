@@ -0,0 +1,246 @@
+"""Module for Blender compositor node implementations of the filters in filters.py
+Filters run in Blender's compositor during the render, so no write-then-read round trip through Python is needed
+See https://docs.blender.org/manual/en/latest/compositing/, specifically filter nodes and transform nodes
+
+Each add_* function takes the socket carrying the image so far and returns the socket carrying the filtered image.
+The blur and grayscale graphs are expected to match the NumPy versions within filters.NODE_TOLERANCES and the noise graph
+to match its mean and standard deviation, while the glow, motion blur and lens flare graphs only imitate their look.
+measure_filter_match() measures the actual differences.
+Note the compositor works on scene linear colors before the view transform, so comparisons are made on linear values
+"""
+
+import bpy
+import math
+import os
+import numpy as np
+import filters
+from utils import FilterSettings, RenderSettings
+
+# Blender's Gaussian blur kernel has a standard deviation of a third of its size
+BLUR_SIZE_PER_SIGMA = 3.0
+
+# noise textures have no settings, so always use the default noise depth
+NOISE_TEXTURE_DEPTH = 2
+
+def noise_texture_moments(depth=NOISE_TEXTURE_DEPTH):
+    """Mean and standard deviation of a noise texture's values
+
+    Each value is the product of depth+1 random integers in 0-3, divided by 3^(depth+1)
+    """
+
+    mean = 0.5**(depth+1) # each factor has a mean of 1.5/3
+    mean_sq = (7/18)**(depth+1) # and a mean square of 3.5/9
+
+    return mean, math.sqrt(mean_sq - mean**2)
+
+def add_gaussian_blur(tree, socket, sigma:float):
+    blur = tree.nodes.new('CompositorNodeBlur')
+    blur.filter_type = 'GAUSS'
+    blur.use_relative = False
+    blur.size_x = blur.size_y = max(1, round(BLUR_SIZE_PER_SIGMA * sigma))
+    tree.links.new(socket, blur.inputs['Image'])
+
+    return blur.outputs['Image']
+
+def add_gaussian_noise(tree, socket, std:float, mean=0.0):
+    """Adds noise with the given mean and standard deviation (on 0-1 intensities)
+
+    The compositor has no Gaussian noise source, so noise from a noise texture is shifted and scaled to the same
+    mean and standard deviation. Its distribution is skewed, with most values 0, so only those two moments match.
+    The same noise is added to every channel
+    """
+
+    texture = bpy.data.textures.new('bssig_noise', type='NOISE')
+    noise = tree.nodes.new('CompositorNodeTexture')
+    noise.texture = texture
+
+    texture_mean, texture_std = noise_texture_moments()
+    centered = tree.nodes.new('CompositorNodeMath')
+    centered.operation = 'MULTIPLY_ADD'
+    tree.links.new(noise.outputs['Value'], centered.inputs[0])
+    centered.inputs[1].default_value = std / texture_std
+    centered.inputs[2].default_value = mean - texture_mean * std / texture_std
+
+    add = tree.nodes.new('CompositorNodeMixRGB')
+    add.blend_type = 'ADD'
+    add.use_clamp = True
+    add.inputs['Fac'].default_value = 1.0
+    tree.links.new(socket, add.inputs[1])
+    tree.links.new(centered.outputs['Value'], add.inputs[2])
+
+    return add.outputs['Image']
+
+def add_grayscale(tree, socket):
+    gray = tree.nodes.new('CompositorNodeRGBToBW')
+    tree.links.new(socket, gray.inputs['Image'])
+
+    return gray.outputs['Val']
+
+def add_fog_glow(tree, socket, threshold=0.8, size=8, mix=0.0):
+    glare = tree.nodes.new('CompositorNodeGlare')
+    glare.glare_type = 'FOG_GLOW'
+    glare.quality = 'HIGH'
+    glare.threshold = threshold
+    glare.size = size
+    glare.mix = mix
+    tree.links.new(socket, glare.inputs['Image'])
+
+    return glare.outputs['Image']
+
+def add_motion_blur(tree, socket, length:float, render_settings:RenderSettings, angle=0.0, num_steps=16):
+    """Adds linear motion blur of length pixels at angle degrees
+
+    The directional blur node's distance is relative to the image diagonal, so length is converted using the render resolution
+    """
+
+    diagonal = math.hypot(
+        render_settings.num_horiz_pixels * render_settings.resolution_perc / 100,
+        render_settings.num_vert_pixels * render_settings.resolution_perc / 100,
+        )
+
+    dblur = tree.nodes.new('CompositorNodeDBlur')
+    dblur.iterations = filters.motion_blur_iterations(num_steps) # the node takes 2^iterations samples
+    dblur.distance = length / diagonal
+    dblur.angle = math.radians(angle)
+    tree.links.new(socket, dblur.inputs['Image'])
+
+    return dblur.outputs['Image']
+
+def add_lens_flare(tree, socket, threshold=0.8, num_ghosts=4, mix=0.0):
+    glare = tree.nodes.new('CompositorNodeGlare')
+    glare.glare_type = 'GHOSTS'
+    glare.quality = 'HIGH'
+    glare.threshold = threshold
+    glare.iterations = min(max(num_ghosts, 2), 5) # node supports 2-5
+    glare.mix = mix
+    tree.links.new(socket, glare.inputs['Image'])
+
+    return glare.outputs['Image']
+
+def filter_steps(filter_settings:FilterSettings, render_settings:RenderSettings):
+    """Each enabled filter, in the order the compositor applies them
+
+    Returns:
+        list of (filter name, function adding its node graph, its NumPy version)
+    """
+
+    fs = filter_settings
+    steps = []
+
+    if fs.motion_blur_length is not None:
+        steps.append((
+            'motion_blur',
+            lambda tree, socket: add_motion_blur(tree, socket, fs.motion_blur_length, render_settings, angle=fs.motion_blur_angle),
+            lambda img: filters.apply_motion_blur(img, fs.motion_blur_length, angle=fs.motion_blur_angle),
+            ))
+    if fs.gaussian_blur_sigma is not None:
+        steps.append((
+            'gaussian_blur',
+            lambda tree, socket: add_gaussian_blur(tree, socket, fs.gaussian_blur_sigma),
+            lambda img: filters.apply_gaussian_blur(img, fs.gaussian_blur_sigma),
+            ))
+    if fs.glow_threshold is not None:
+        steps.append((
+            'fog_glow',
+            lambda tree, socket: add_fog_glow(tree, socket, threshold=fs.glow_threshold, size=fs.glow_size),
+            lambda img: filters.apply_fog_glow(img, threshold=fs.glow_threshold, size=fs.glow_size),
+            ))
+    if fs.lens_flare_threshold is not None:
+        steps.append((
+            'lens_flare',
+            lambda tree, socket: add_lens_flare(tree, socket, threshold=fs.lens_flare_threshold, num_ghosts=fs.lens_flare_ghosts),
+            lambda img: filters.apply_lens_flare(img, threshold=fs.lens_flare_threshold, num_ghosts=fs.lens_flare_ghosts),
+            ))
+    if fs.noise_std is not None:
+        steps.append((
+            'gaussian_noise',
+            lambda tree, socket: add_gaussian_noise(tree, socket, fs.noise_std, mean=fs.noise_mean),
+            lambda img: filters.apply_gaussian_noise(img*255, fs.noise_std*255, mean=fs.noise_mean*255) / 255,
+            ))
+    if fs.grayscale:
+        steps.append(('grayscale', add_grayscale, filters.apply_grayscale))
+
+    return steps
+
+def _composite_sockets():
+    scene = bpy.context.scene
+    scene.use_nodes = True
+    tree = scene.node_tree
+
+    rlayers = next((node for node in tree.nodes if node.type == 'R_LAYERS'), None) or tree.nodes.new('CompositorNodeRLayers')
+    composite = next((node for node in tree.nodes if node.type == 'COMPOSITE'), None) or tree.nodes.new('CompositorNodeComposite')
+
+    # keep any existing compositing, e.g. region render backgrounds
+    if composite.inputs['Image'].is_linked:
+        socket = composite.inputs['Image'].links[0].from_socket
+    else:
+        socket = rlayers.outputs['Image']
+
+    return tree, socket, composite.inputs['Image']
+
+def setup_filter_compositing(filter_settings:FilterSettings, render_settings:RenderSettings):
+    """Inserts a node graph applying each enabled filter right before the compositor's output
+    """
+
+    tree, socket, output = _composite_sockets()
+
+    for _, add_nodes, _ in filter_steps(filter_settings, render_settings):
+        socket = add_nodes(tree, socket)
+
+    tree.links.new(socket, output)
+
+def _add_clamp(tree, socket):
+    clamp = tree.nodes.new('CompositorNodeMixRGB')
+    clamp.use_clamp = True
+    clamp.inputs['Fac'].default_value = 0.0 # passes the 1st image through, clamped to 0-1
+    tree.links.new(socket, clamp.inputs[1])
+
+    return clamp.outputs['Image']
+
+def _render_linear(filepath:str):
+    # EXRs hold the compositor's scene linear output, without the view transform
+    render = bpy.context.scene.render
+    render.image_settings.file_format = 'OPEN_EXR'
+    render.image_settings.color_depth = '32'
+    render.filepath = filepath
+    bpy.ops.render.render(write_still=True)
+
+    # stills are written without a frame number
+    img = bpy.data.images.load(bpy.path.abspath(render.filepath) + '.exr')
+    width, height = img.size
+    pixels = np.array(img.pixels[:], dtype=np.float64).reshape(height, width, img.channels)
+    bpy.data.images.remove(img)
+
+    return pixels[::-1, :, :3] # Blender stores rows bottom to top
+
+def measure_filter_match(filter_settings:FilterSettings, render_settings:RenderSettings, output_dir=''):
+    """Measures how closely each enabled filter's node graph matches its NumPy version on the current scene
+
+    The scene is rendered once unfiltered and once per filter with only that filter's node graph, all as scene linear
+    EXRs. Each NumPy filter is applied to the unfiltered render and compared with filters.matches_node_output.
+    The render is clamped to 0-1 in the compositor before the filters, as the NumPy filters expect values in that range,
+    so both versions filter the same image.
+    Expects a scene without filter compositing set up, and leaves the output format as EXR
+
+    Returns:
+        dict of filter name to difference, tolerance (or None if none is stated), and whether it's within tolerance
+    """
+
+    tree, unfiltered, output = _composite_sockets()
+    clamped = _add_clamp(tree, unfiltered)
+
+    tree.links.new(clamped, output)
+    raw = _render_linear(os.path.join(output_dir, 'filter_match_unfiltered'))
+
+    res = {}
+    for name, add_nodes, apply_filter in filter_steps(filter_settings, render_settings):
+        tree.links.new(add_nodes(tree, clamped), output)
+        node_img = np.clip(_render_linear(os.path.join(output_dir, f'filter_match_{name}')), 0.0, 1.0)
+
+        diff, within = filters.matches_node_output(apply_filter(raw), node_img, name)
+        res[name] = {'difference': diff, 'tolerance': filters.NODE_TOLERANCES.get(name), 'within_tolerance': within}
+
+    tree.links.new(unfiltered, output)
+    tree.nodes.remove(clamped.node)
+
+    return res
@@ -1,17 +1,36 @@
 """Module for image filter functions
-Filters are implemented using Python and Blender compositor nodes
+Filters are implemented using Python here and Blender compositor nodes in filter_nodes.py
 See https://docs.blender.org/manual/en/latest/compositing/, specifically filter nodes and transform nodes
 """
 
+import math
 import scipy as sp
 import numpy as np
 from skimage import color
 
+# mean absolute difference (on 0-1 scene linear intensities) expected between a filter and its compositor node graph
+# in filter_nodes.py, derived from the node definitions rather than measured. Blur differs only by rounding the kernel size
+# to whole pixels and truncating it at 3 rather than 4 standard deviations, and grayscale only by Rec. 709 luma coefficients
+# in the 4th decimal place. Noise is random and its node graph uses a differently shaped distribution, which clipping to 0-1
+# affects differently, so no tolerance is stated for it until one is measured. Neither is one for the glare and directional
+# blur nodes, which use their own kernels that the NumPy versions only imitate.
+# Measure actual differences against a render with img_gen.py --measure-filters
+NODE_TOLERANCES = {
+    'gaussian_blur': 0.005,
+    'grayscale': 0.001,
+}
+
+def _spatial(img:np.ndarray, val:float):
+    # per axis parameter that leaves the channel axis untouched
+    return (val, val) if img.ndim == 2 else (val, val) + (0,)*(img.ndim-2)
+
 def apply_gaussian_blur(img:np.ndarray, sigma:float):
     """Applies Gaussian blurring to the image
+
+    Each channel is blurred separately
     """
 
-    return sp.ndimage.gaussian_filter(img, sigma=sigma)
+    return sp.ndimage.gaussian_filter(img, sigma=_spatial(img, sigma))
 
 def apply_gaussian_noise(img:np.ndarray, variance:float, mean=0.0):
     """Applies Gaussian noise to the image
@@ -24,11 +43,109 @@ def apply_gaussian_noise(img:np.ndarray, variance:float, mean=0.0):
 def apply_grayscale(img:np.ndarray):
     return color.rgb2gray(img)
 
-def apply_lens_flare():
-    pass
+def _highlights(img:np.ndarray, threshold:float):
+    # parts of the image brighter than the threshold, which glare effects spread out
+    return np.clip(img - threshold, 0.0, None)
+
+def _mix_glare(img:np.ndarray, glare:np.ndarray, mix:float):
+    # same as the Glare node, where 0 adds the glare to the image and -1/1 fade out the glare/image
+    return np.clip((1.0 - max(mix, 0.0)) * img + (1.0 + min(mix, 0.0)) * glare, 0.0, 1.0)
+
+def apply_fog_glow(img:np.ndarray, threshold=0.8, size=8, mix=0.0):
+    """Applies a glow around bright parts of the image
+
+    Args:
+        img: float image with values in range 0-1
+
+        threshold: intensity above which pixels glow
+
+        size: glow spreads over about 2^size pixels, matching the range (6-9) of Blender's Glare node
+
+        mix: -1 for only the original image, 1 for only the glow, 0 to add the glow to the image
+    """
+
+    glow = sp.ndimage.gaussian_filter(_highlights(img, threshold), sigma=_spatial(img, 2**size / 6))
+
+    return _mix_glare(img, glow, mix)
+
+def motion_blur_iterations(num_steps:int):
+    """Directional Blur node iterations giving at least num_steps samples, as the node takes 2^iterations samples
+    """
+
+    return max(1, math.ceil(math.log2(max(num_steps, 1))))
+
+def apply_motion_blur(img:np.ndarray, length:float, angle=0.0, num_steps=16):
+    """Applies linear motion blur, averaging copies of the image translated up to length pixels at angle degrees
+
+    num_steps is rounded up to a power of 2, the number of samples the Directional Blur node takes
+
+    Args:
+        img: float image with values in range 0-1
+
+        length: distance in pixels the image moves over the exposure
+
+        angle: direction of motion in degrees, counterclockwise from the +x axis
+
+        num_steps: minimum number of translated copies averaged
+    """
+
+    num_steps = 2**motion_blur_iterations(num_steps)
+    dx, dy = np.cos(np.radians(angle)), -np.sin(np.radians(angle)) # image rows increase downwards
+
+    res = np.zeros_like(img, dtype=np.float64)
+    for t in np.linspace(0.0, length, num_steps):
+        shift = (t*dy, t*dx) + (0,)*(img.ndim-2)
+        res += sp.ndimage.shift(img, shift, order=1, mode='nearest')
+
+    return res / num_steps
+
+def apply_lens_flare(img:np.ndarray, threshold=0.8, num_ghosts=4, mix=0.0):
+    """Applies lens flare ghosts, i.e. blurred copies of bright parts of the image reflected through its center at different scales
+
+    Args:
+        img: float image with values in range 0-1
+
+        threshold: intensity above which pixels cause ghosts
+
+        num_ghosts: number of ghost copies
+
+        mix: -1 for only the original image, 1 for only the ghosts, 0 to add the ghosts to the image
+    """
+
+    highlights = _highlights(img, threshold)
+    height, width = img.shape[:2]
+    center = np.array([(height-1) / 2.0, (width-1) / 2.0])
+
+    ghosts = np.zeros_like(img, dtype=np.float64)
+    for k in range(num_ghosts):
+        scale = -0.5 * (k+1) # negative scales reflect through the center
+        # output pixel p samples the highlights at center + (p - center) / scale
+        matrix = np.diag([1.0 / scale, 1.0 / scale] + [1.0]*(img.ndim-2))
+        offset = np.concatenate([center - center / scale, np.zeros(img.ndim-2)])
+        ghost = sp.ndimage.affine_transform(highlights, matrix, offset=offset, order=1, mode='constant')
+        ghosts += sp.ndimage.gaussian_filter(ghost, sigma=_spatial(img, 2.0*(k+1))) / num_ghosts
+
+    return _mix_glare(img, ghosts, mix)
+
+def matches_node_output(numpy_img:np.ndarray, node_img:np.ndarray, filter_name:str):
+    """Compares a compositor node graph's output to the NumPy filter's
+
+    Both images should be float with values in range 0-1, and compared in the same (scene linear) color space
+
+    Returns:
+        the difference (mean absolute difference, or the larger of the mean and standard deviation differences for noise)
+        and whether it's within NODE_TOLERANCES, or None if no tolerance is stated for the filter
+    """
+
+    if numpy_img.ndim == 2 and node_img.ndim == 3:
+        node_img = node_img[..., 0] # single channel filters come out of the compositor as gray RGB
+
+    if filter_name == 'gaussian_noise':
+        diff = float(max(abs(numpy_img.mean() - node_img.mean()), abs(numpy_img.std() - node_img.std())))
+    else:
+        diff = float(np.abs(numpy_img - node_img).mean())
 
-def apply_flog_glow():
-    pass
+    if filter_name not in NODE_TOLERANCES:
+        return diff, None
 
-def apply_motion_blur():
-    pass
+    return diff, diff <= NODE_TOLERANCES[filter_name]
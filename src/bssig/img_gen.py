@@ -1,16 +1,20 @@
 """Script for generating images of an object in a scene
-with optional image filters applied
+with optional image filters applied by Blender's compositor during the render
 """
 
 import bpy
 import argparse
+import json
+import random
 import sys
 import os
 
 sys.path.append(os.path.dirname(__file__))
 
 import scene_utils as su
+import filter_nodes
 import utils
+import work_queue as wq
 
 def get_args_parser():
     parser = argparse.ArgumentParser(description='BSSIG - Blender Synthetic Space Imagery Generator', add_help=True)
@@ -19,14 +23,16 @@ def get_args_parser():
         "space_scene_path",
         metavar="space-scene-path",
         type=str,
-        help="Path to space scene to render in Blender",
+        nargs='?',
+        help="Path to space scene to render in Blender. Not needed by job workers",
         )
     
     parser.add_argument(
         'object_path',
         metavar='object-path',
         type=str,
-        help='Path to 3D object to render in space scene',
+        nargs='?',
+        help='Path to 3D object to render in space scene. Not needed by job workers',
         )
     
     parser.add_argument(
@@ -142,6 +148,13 @@ def get_args_parser():
         help='The maximum x, y, z rotations when randomly choosing the object\'s rotation.',
         )
     
+    parser.add_argument(
+        '--num-views', 
+        type=int, 
+        default=1, 
+        help='Number of tracking cameras to render each object pose from. --camera-dist only applies to the first, the others are positioned randomly or by --pose-sampler. Images are saved as img<i>_view<k> if more than 1.',
+        )
+    
     parser.add_argument(
         '--min-camera-rot-perturb', 
         type=float,
@@ -158,6 +171,21 @@ def get_args_parser():
         help='Maximum random perturbation x, y, z rotations for camera rotation.',
         )
         
+    parser.add_argument(
+        '--pose-sampler', 
+        type=str, 
+        choices=['random','sobol','stratified'], 
+        default='random', 
+        help='''How random object rotations, camera positions and sun angles are sampled.
+        random - Independent uniform samples for each image.
+        sobol - Scrambled Sobol sequence over the joint pose space.
+        stratified - Latin hypercube over the joint pose space.
+        In every case camera directions are uniform on the sphere, and object rotations are uniform over all orientations if the rotation range spans a full turn.
+        The view sphere coverage and joint discrepancy of the poses are saved as a JSON, so methods can be compared.''',
+        )
+    
+    parser.add_argument('--seed', type=int, default=None, help='RNG seed for random positions, rotations and pose sampling.',)
+
     parser.add_argument(
         '--sun-dist', 
         type=float, 
@@ -203,6 +231,74 @@ def get_args_parser():
     
     parser.add_argument('--num-vert-pixels', type=int, default=1080, help='Number of vertical pixels in generated images.',)
 
+    parser.add_argument('--gaussian-blur', type=float, default=None, help='If specified, blur images with a Gaussian of this standard deviation in pixels.',)
+
+    parser.add_argument('--gaussian-noise', type=float, default=None, help='If specified, add noise with this standard deviation (on 0-1 intensities) to images.',)
+
+    parser.add_argument('--noise-mean', type=float, default=0.0, help='Mean of the noise added with --gaussian-noise.',)
+
+    parser.add_argument('--grayscale', action='store_true', help='Convert images to grayscale.',)
+
+    parser.add_argument('--fog-glow', type=float, default=None, help='If specified, add a glow around parts of images brighter than this intensity.',)
+
+    parser.add_argument('--glow-size', type=int, default=8, choices=[6, 7, 8, 9], help='Glow spreads over about 2^size pixels.',)
+
+    parser.add_argument('--motion-blur', type=float, default=None, help='If specified, add linear motion blur of this length in pixels.',)
+
+    parser.add_argument('--motion-blur-angle', type=float, default=0.0, help='Direction of motion blur in degrees, counterclockwise from horizontal.',)
+
+    parser.add_argument('--lens-flare', type=float, default=None, help='If specified, add lens flare ghosts from parts of images brighter than this intensity.',)
+
+    parser.add_argument('--lens-flare-ghosts', type=int, default=4, help='Number of lens flare ghosts.',)
+
+    parser.add_argument(
+        '--measure-filters', 
+        action='store_true', 
+        help='Instead of generating images, measure how closely each enabled filter\'s compositor node graph matches its NumPy version on the first pose, saving the differences as a JSON.',
+        )
+
+    parser.add_argument(
+        '--region-render', 
+        action='store_true', 
+        help='Only render the region of the frame around the object, compositing it over a black or cached background. The world (e.g. stars) is rendered transparent, so is replaced by that background. Falls back to a full render when other scene geometry (e.g. the Earth) may be in view.',
+        )
+    
+    parser.add_argument(
+        '--region-margin', 
+        type=float, 
+        default=0.05, 
+        help='Padding around the object\'s projected bounding box when region rendering, as a fraction of the frame.',
+        )
+    
+    parser.add_argument(
+        '--background-image', 
+        type=str, 
+        default=None, 
+        help='Path to a cached background image to composite region renders over, e.g. a render of the world alone. It is used as is for every frame, so only suits backgrounds that don\'t change with camera pose. Analytically black if unspecified.',
+        )
+
+    parser.add_argument(
+        '--job-dir', 
+        type=str, 
+        default=None, 
+        help='''Path to a job directory on a filesystem shared between nodes.
+        With --create-job, splits --num-images into chunks and writes the job there.
+        Otherwise, runs as a worker that claims and renders chunks until the job is done, using every setting the job was created with other than --worker-id.''',
+        )
+    
+    parser.add_argument('--create-job', action='store_true', help='Create a job in --job-dir rather than rendering.',)
+
+    parser.add_argument('--chunk-size', type=int, default=10, help='Number of images per job chunk.',)
+
+    parser.add_argument(
+        '--lease-secs', 
+        type=float, 
+        default=600.0, 
+        help='How long a worker\'s claim on a chunk lasts without progress before other workers can reclaim it. Renewed after every image, so should exceed the time to render one.',
+        )
+
+    parser.add_argument('--worker-id', type=str, default=None, help='Name of this worker in job leases. Defaults to hostname and process ID.',)
+
     parser.add_argument(
         '--output-dir', 
         type=str, 
@@ -212,86 +308,206 @@ def get_args_parser():
     
     return parser
 
-def main():
-    parser = get_args_parser()
+def render_image(i:int, args, obj_name:str, camera_settings:utils.CameraSettings, render_settings:utils.RenderSettings, pose_sampler:su.PoseSampler|None=None, render_fn=None):
+    """Poses the object and sun for the i-th image, then positions and renders each view camera
 
-    args = parser.parse_args(utils.get_script_args())
+    If specified, render_fn is called with each view's output path instead of rendering it
+    """
 
-    if args.output_dir != '':
-        utils.mkdir(args.output_dir)
-
-    camera_settings, render_settings, sun_settings = utils.parser_camera_settings(args), utils.parse_render_settings(args), utils.parse_sun_settings(args)
-    
-    obj_name = su.setup_scene(args.space_scene_path, args.object_path, camera_settings, render_settings, sun_settings)
-
-    # render loop
-    for i in range(args.num_images):
-        if args.reference_object:
-            # distance positioning
-            if args.object_dist is not None:
-                # static distance
-                su.set_object_dist(
-                    obj_name, 
-                    args.reference_object, 
-                    args.object_dist,
-                    )
-            else:
-                # random distance
-                su.rand_set_object_dist(
-                    obj_name, 
-                    args.reference_object, 
-                    args.min_object_dist, 
-                    args.max_object_dist,
-                    )
+    if args.reference_object:
+        # distance positioning
+        if args.object_dist is not None:
+            # static distance
+            su.set_object_dist(
+                obj_name, 
+                args.reference_object, 
+                args.object_dist,
+                )
         else:
-            # absolute positioning
-            if args.object_pos is not None:
-                # static absolute position
-                su.set_object_pos(obj_name, args.object_pos,)
-            else:
-                # random absolute position
-                su.rand_set_object_pos(
-                    obj_name, 
-                    args.min_object_pos, 
-                    args.max_object_pos,
-                    )
-        
-        if args.object_rot is not None:
-            su.set_object_rot(obj_name, args.object_rot)
+            # random distance
+            su.rand_set_object_dist(
+                obj_name, 
+                args.reference_object, 
+                args.min_object_dist, 
+                args.max_object_dist,
+                )
+    else:
+        # absolute positioning
+        if args.object_pos is not None:
+            # static absolute position
+            su.set_object_pos(obj_name, args.object_pos,)
         else:
-            su.rand_set_object_rot(
+            # random absolute position
+            su.rand_set_object_pos(
                 obj_name, 
-                args.min_object_rot, 
-                args.max_object_rot,
+                args.min_object_pos, 
+                args.max_object_pos,
                 )
-            
+    
+    if args.object_rot is not None:
+        su.set_object_rot(obj_name, args.object_rot)
+    elif pose_sampler is not None:
+        su.set_object_rot(obj_name, pose_sampler.object_rot(i))
+    else:
+        su.rand_set_object_rot(
+            obj_name, 
+            args.min_object_rot, 
+            args.max_object_rot,
+            )
+        
+    if pose_sampler is not None:
+        su.set_sun_pos(args.sun_dist, pose_sampler.sun_angle(i))
+    else:
         su.rand_set_sun_pos(args.sun_dist)
 
-        if args.camera_dist is not None:
+    # the object and sun stay put while each view camera is positioned and rendered in turn
+    for view, camera_name in enumerate(camera_settings.view_names):
+        if args.camera_dist is not None and view == 0:
             su.set_object_dist(
-                camera_settings.name, 
+                camera_name, 
                 obj_name, 
                 args.camera_dist,
                 )
+        elif pose_sampler is not None:
+            su.set_object_dist(
+                camera_name, 
+                obj_name, 
+                pose_sampler.camera_xyz(i, view=view),
+                )
         else:
             su.rand_set_object_dist(
-                camera_settings.name,
+                camera_name,
                 obj_name, 
                 args.min_camera_dist, 
                 args.max_camera_dist,
                 )
 
         if args.camera_rot is not None:
-            su.set_object_rot(camera_settings.name, args.camera_rot)
+            su.set_object_rot(camera_name, args.camera_rot)
         else:
             su.rand_set_camera_perturb(
-                camera_name=camera_settings.name,
+                camera_name=camera_name,
                 min_xyz_perturbs=args.min_camera_rot_perturb, 
                 max_xyz_perturbs=args.max_camera_rot_perturb,
                 )
 
-        bpy.context.scene.render.filepath = os.path.join(args.output_dir, f'img{i}')
+        bpy.context.scene.camera = bpy.data.objects[camera_name]
+
+        if render_settings.use_region_render:
+            su.set_render_region(obj_name, camera_name=camera_name, margin=render_settings.region_margin)
+
+        filename = f'img{i}' if len(camera_settings.view_names) == 1 else f'img{i}_view{view}'
+        if render_fn is not None:
+            render_fn(os.path.join(args.output_dir, filename))
+            continue
+
+        bpy.context.scene.render.filepath = os.path.join(args.output_dir, filename)
 
         bpy.ops.render.render(write_still=True)
 
+def make_pose_sampler(args):
+    return su.PoseSampler(
+        args.num_images, 
+        args.min_object_rot, 
+        args.max_object_rot, 
+        args.min_camera_dist, 
+        args.max_camera_dist, 
+        num_views=args.num_views, 
+        method=args.pose_sampler, 
+        seed=args.seed,
+        )
+
+def save_pose_coverage(pose_sampler:su.PoseSampler, output_dir:str):
+    coverage = pose_sampler.coverage()
+    print(coverage)
+    with open(os.path.join(output_dir, 'pose_coverage.json'), 'w') as f:
+        json.dump(coverage, f)
+
+def main():
+    parser = get_args_parser()
+
+    args = parser.parse_args(utils.get_script_args())
+
+    if args.create_job:
+        if args.job_dir is None:
+            raise Exception('--create-job requires --job-dir')
+        if args.space_scene_path is None or args.object_path is None:
+            parser.error('space-scene-path and object-path are required')
+
+        # paths must resolve the same on every node, not relative to each one's working directory
+        args.space_scene_path, args.object_path = os.path.abspath(args.space_scene_path), os.path.abspath(args.object_path)
+        args.output_dir = os.path.abspath(args.output_dir)
+        if args.background_image is not None:
+            args.background_image = os.path.abspath(args.background_image)
+
+        job = wq.create_job(
+            args.job_dir, 
+            args.num_images, 
+            args.chunk_size, 
+            lease_secs=args.lease_secs, 
+            seed=args.seed, 
+            args={k: v for k, v in vars(args).items() if k != 'seed'},
+            )
+        print(f'Created job of {job["num_chunks"]} chunks in {args.job_dir}')
+
+        args.seed = job['seed']
+        utils.mkdir(args.output_dir)
+        save_pose_coverage(make_pose_sampler(args), args.output_dir)
+        return
+
+    job = None
+    if args.job_dir is not None:
+        # every worker renders with the coordinator's settings, so a reclaimed chunk renders the same frames on any node
+        job = wq.load_job(args.job_dir)
+        args = argparse.Namespace(**{**job['args'], 'seed': job['seed'], 'job_dir': args.job_dir, 'create_job': False, 'worker_id': args.worker_id})
+    elif args.space_scene_path is None or args.object_path is None:
+        parser.error('space-scene-path and object-path are required')
+
+    if args.output_dir != '':
+        utils.mkdir(args.output_dir)
+
+    camera_settings, render_settings, sun_settings = utils.parser_camera_settings(args), utils.parse_render_settings(args), utils.parse_sun_settings(args)
+    filter_settings = utils.parse_filter_settings(args)
+    
+    # filters are measured one at a time, so aren't set up in the scene
+    obj_name = su.setup_scene(
+        args.space_scene_path, 
+        args.object_path, 
+        camera_settings, 
+        render_settings, 
+        sun_settings, 
+        filter_settings=None if args.measure_filters else filter_settings,
+        )
+
+    random.seed(args.seed)
+
+    pose_sampler = make_pose_sampler(args)
+
+    if args.measure_filters:
+        res = []
+        render_image(
+            0, args, obj_name, camera_settings, render_settings, pose_sampler=pose_sampler, 
+            render_fn=lambda filepath: res.append(filter_nodes.measure_filter_match(filter_settings, render_settings, output_dir=args.output_dir)),
+            )
+        print(res)
+        with open(os.path.join(args.output_dir, 'filter_match.json'), 'w') as f:
+            json.dump(res, f)
+        return
+    if job is None:
+        # job workers leave this to the coordinator, rather than each recomputing it
+        save_pose_coverage(pose_sampler, args.output_dir)
+
+    if job is not None:
+        wq.run_worker(
+            args.job_dir, 
+            lambda i: render_image(i, args, obj_name, camera_settings, render_settings, pose_sampler=pose_sampler), 
+            worker_id=args.worker_id, 
+            on_chunk_start=lambda chunk: random.seed(f'{args.seed}-{chunk}'), # chunks render the same wherever they're claimed
+            )
+        return
+
+    # render loop
+    for i in range(args.num_images):
+        render_image(i, args, obj_name, camera_settings, render_settings, pose_sampler=pose_sampler)
+
 main()
@@ -0,0 +1,192 @@
+"""Module for streaming dataset-level pixel intensity statistics
+Images are folded into an accumulator one at a time, so whole datasets never need to be held in memory
+"""
+
+import os
+import skimage
+import numpy as np
+from multiprocessing import Pool
+from skimage import img_as_float, img_as_ubyte
+
+import filters
+
+NUM_BINS = 256
+
+def to_intensity(img:np.ndarray, to_grayscale=True):
+    """Converts an image to a 2D float intensity image with values in range 0-1
+    """
+
+    img = img_as_float(img)
+
+    if img.ndim == 3:
+        if img.shape[-1] == 4:
+            img = img[..., :3] # drop alpha channel
+        if to_grayscale:
+            img = filters.apply_grayscale(img)
+
+    return img
+
+class IntensityAccumulator:
+    """Streaming pixel intensity histogram with running mean, variance, and percentiles
+
+    The histogram is built by integer bincount over uint8 intensities, while the mean and variance
+    are tracked on the unquantized 0-1 intensities and combined with Chan et al.'s parallel update.
+    Accumulators built on separate processes can be combined with merge()
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self.counts = np.zeros(NUM_BINS, dtype=np.int64)
+        self.num_imgs = 0
+        self.num_pixels = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _combine_moments(self, n:int, mean:float, m2:float):
+        total = self.num_pixels + n
+        if total == 0:
+            return
+
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.num_pixels * n / total
+        self.num_pixels = total
+
+    def update(self, img:np.ndarray, to_grayscale=True):
+        """Adds a single image to the accumulator
+        """
+
+        img = to_intensity(img, to_grayscale=to_grayscale)
+
+        self.counts += np.bincount(img_as_ubyte(np.clip(img, 0.0, 1.0)).ravel(), minlength=NUM_BINS)
+
+        mean = float(img.mean())
+        m2 = float(np.square(img - mean).sum())
+        self._combine_moments(img.size, mean, m2)
+        self.num_imgs += 1
+
+        return self
+
+    def merge(self, other:'IntensityAccumulator'):
+        """Merges another accumulator into this one in place
+        """
+
+        self.counts += other.counts
+        self._combine_moments(other.num_pixels, other.mean, other.m2)
+        self.num_imgs += other.num_imgs
+
+        return self
+
+    @property
+    def variance(self):
+        if self.num_pixels == 0:
+            return 0.0
+        return self.m2 / self.num_pixels
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    def percentiles(self, q):
+        """Calculates intensity percentiles (0-100) from the histogram
+
+        Results are in range 0-1 and resolved to the width of one histogram bin
+        """
+
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if self.num_pixels == 0:
+            return np.full(q.shape, np.nan)
+
+        cdf = np.cumsum(self.counts)
+        ranks = np.ceil(q / 100.0 * cdf[-1]).clip(1, cdf[-1])
+        bins = np.searchsorted(cdf, ranks, side='left')
+
+        return bins / (NUM_BINS - 1)
+
+    def density(self):
+        """Normalized histogram, useful for comparing datasets of different sizes
+        """
+
+        total = self.counts.sum()
+        if total == 0:
+            return np.zeros(NUM_BINS, dtype=np.float64)
+        return self.counts / total
+
+    def summary(self, q=(1, 5, 25, 50, 75, 95, 99)):
+        res = {
+            'name': self.name,
+            'num_imgs': self.num_imgs,
+            'num_pixels': self.num_pixels,
+            'mean': self.mean,
+            'std': self.std,
+        }
+        for p, val in zip(q, self.percentiles(q)):
+            res[f'p{p}'] = float(val)
+
+        return res
+
+    def save(self, filepath:str):
+        np.savez(
+            filepath,
+            name=self.name,
+            counts=self.counts,
+            moments=np.array([self.num_imgs, self.num_pixels, self.mean, self.m2], dtype=np.float64),
+            )
+
+    @classmethod
+    def load(cls, filepath:str):
+        data = np.load(filepath)
+
+        acc = cls(name=str(data['name']))
+        acc.counts = data['counts'].astype(np.int64)
+        num_imgs, num_pixels, mean, m2 = data['moments']
+        acc.num_imgs, acc.num_pixels, acc.mean, acc.m2 = int(num_imgs), int(num_pixels), float(mean), float(m2)
+
+        return acc
+
+def _accumulate_paths(img_paths, to_grayscale=True):
+    acc = IntensityAccumulator()
+    for path in img_paths:
+        acc.update(skimage.io.imread(path), to_grayscale=to_grayscale)
+
+    return acc
+
+def accumulate_paths(img_paths, to_grayscale=True, num_workers=1, name=''):
+    """Streams a list of images through an IntensityAccumulator
+
+    Args:
+        img_paths: paths to images
+
+        to_grayscale: convert color images to grayscale intensity, otherwise every channel is counted
+
+        num_workers: number of processes to split the images across, each worker's accumulator is merged at the end
+
+        name: label for the accumulator
+    """
+
+    acc = IntensityAccumulator(name=name)
+
+    if num_workers <= 1 or len(img_paths) <= 1:
+        return acc.merge(_accumulate_paths(img_paths, to_grayscale=to_grayscale))
+
+    chunks = [chunk.tolist() for chunk in np.array_split(np.array(img_paths, dtype=object), num_workers) if len(chunk) > 0]
+    with Pool(processes=num_workers) as pool:
+        for worker_acc in pool.starmap(_accumulate_paths, [(chunk, to_grayscale) for chunk in chunks]):
+            acc.merge(worker_acc)
+
+    return acc
+
+def accumulate_dir(filepath:str, to_grayscale=True, num_workers=1, name=None):
+    """Streams every image in a directory through an IntensityAccumulator, see accumulate_paths
+
+    The name defaults to the directory name
+    """
+
+    img_paths = sorted([entry.path for entry in os.scandir(filepath) if entry.is_file()])
+
+    return accumulate_paths(
+        img_paths,
+        to_grayscale=to_grayscale,
+        num_workers=num_workers,
+        name=name if name is not None else os.path.basename(os.path.normpath(filepath)),
+        )
@@ -8,11 +8,12 @@ import random
 import skimage
 import json
 import pandas as pd
-from skimage import img_as_float
 
 sys.path.append(os.path.dirname(__file__))
 
 import utils
+import img_stats
+import results_store
 import visualization as viz
 
 def get_args_parser():
@@ -48,20 +49,49 @@ def get_args_parser():
         '--calc-ssim', 
         type=str,
         choices=['standard','best-match'],
-        default='standard',
-        help='''SSIM calculation method. Saved as a CSV.
+        default=None,
+        help='''SSIM calculation method. Saved as a CSV. Defaults to standard, unless --intensity-hist is the only result requested, in which case SSIMs are skipped.
         standard - Calculates the SSIM between corresponding pairs of synthetic and reference images. Must have same amount of synthetic and reference images.
         best-match - Calculates the SSIM between all possible pairs of synthetic and reference images, storing the best (highest) one.''',
         )
     
+    parser.add_argument(
+        '--ssim-tile-size', 
+        type=int, 
+        default=None, 
+        help='If specified, calculate SSIM over tiles of this size to bound peak memory on very large images. Results match the full-image calculation.',
+        )
+    
+    parser.add_argument(
+        '--ssim-heatmap-scale', 
+        type=int, 
+        default=None, 
+        help='If specified, save each pair\'s per-pixel SSIM map downsampled by this factor as a heatmap. Only applies to the standard SSIM calculation method without --results-store.',
+        )
+
     parser.add_argument('--ssim-hist', action='store_true', help='Generate a histogram of SSIMs.',)
 
     parser.add_argument('--ssim-boxplot', action='store_true', help='Generate a boxplot of SSIMs.',)
 
+    parser.add_argument(
+        '--intensity-hist', 
+        action='store_true', 
+        help='Stream both image sets (or the --use-n-rand-imgs subsets) through intensity accumulators and plot their pixel intensity histograms together. Color images are always converted to grayscale intensity. Summary statistics are saved as a CSV.',
+        )
+
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of processes to use when accumulating intensity statistics.',)
+
     parser.add_argument('--use-n-rand-imgs', type=int, default=None, help='If specified, n random synthetic/reference images will be chosen for comparison.',)
     
     parser.add_argument('--seed', type=int, default=None, help='RNG seed. Only applies when choosing a random subset of synthetic/reference images.',)
 
+    parser.add_argument(
+        '--results-store', 
+        type=str, 
+        default=None, 
+        help='Path to a SQLite database of previously calculated SSIMs, created if it doesn\'t exist. Only image pairs missing from it are calculated, and results are rebuilt from it.',
+        )
+
     parser.add_argument('--save-cmd-args', action='store_true', help='Save the command line arguments used.',)
 
     parser.add_argument(
@@ -73,29 +103,71 @@ def get_args_parser():
     
     return parser
 
-def load_images(filepath:str, n_rand=None):
+def list_images(filepath:str, n_rand=None):
     img_paths = sorted([entry.path for entry in os.scandir(filepath) if entry.is_file()])
     if n_rand is not None:
         if n_rand > len(img_paths):
             raise Exception(f'{filepath} only contains {len(img_paths)} images, cannot randomly choose {n_rand}')
         img_paths = random.sample(img_paths, n_rand)
 
-    imgs = []
-    for path in img_paths:
-        imgs.append(img_as_float(skimage.io.imread(path)))
+    return img_paths
+
+def load_image(path:str):
+    # kept in its native dtype, SSIM calculations convert to float themselves (one tile at a time when tiled)
+    return skimage.io.imread(path)
+
+class ImageFiles:
+    """List of images that are only loaded from disk when indexed, so at most the images in use are held in memory
+    """
+
+    def __init__(self, img_paths):
+        self.img_paths = img_paths
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, i):
+        return load_image(self.img_paths[i])
+
+def load_images(img_paths, lazy=False):
+    if lazy:
+        imgs = ImageFiles(img_paths)
+    else:
+        imgs = [load_image(path) for path in img_paths]
 
     img_mapping = {i:os.path.basename(img_paths[i]) for i in range(len(img_paths))}
 
     return imgs, img_mapping
 
-def calc_ssims(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_map:dict, to_grayscale=None, save=True, output_dir='', filename='ssims.csv'):
+def calc_ssim(synth_img, ref_img, to_grayscale=None, tile_size=None, heatmap_scale=None):
+    if tile_size is None and heatmap_scale is None:
+        return utils.calc_ssim(synth_img, ref_img, to_grayscale=to_grayscale)
+
+    tile_kwargs = {} if tile_size is None else {'tile_size': tile_size}
+
+    return utils.calc_ssim_tiled(synth_img, ref_img, to_grayscale=to_grayscale, heatmap_scale=heatmap_scale, **tile_kwargs)
+
+def calc_ssims(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_map:dict, to_grayscale=None, tile_size=None, heatmap_scale=None, save=True, output_dir='', filename='ssims.csv'):
     if len(synth_imgs) != len(ref_imgs):
         raise Exception(f'Unequal number of synthetic and reference images: {len(synth_imgs)} and {len(ref_imgs)}')
     
     res = {}
+
+    if heatmap_scale is not None:
+        heatmaps_dir = os.path.join(output_dir, 'ssim_heatmaps')
+        utils.mkdir(heatmaps_dir)
     
     for i in range(len(ref_imgs)):
-        ssim = utils.calc_ssim(synth_imgs[i], ref_imgs[i], to_grayscale=to_grayscale)
+        if heatmap_scale is not None:
+            ssim, ssim_map = calc_ssim(synth_imgs[i], ref_imgs[i], to_grayscale=to_grayscale, tile_size=tile_size, heatmap_scale=heatmap_scale)
+            viz.plot_ssim_heatmap(
+                ssim_map, 
+                title=f'{synth_imgs_map[i]} vs {ref_imgs_map[i]}', 
+                output_dir=heatmaps_dir, 
+                filename=f'{os.path.splitext(synth_imgs_map[i])[0]}_ssim_heatmap',
+                )
+        else:
+            ssim = calc_ssim(synth_imgs[i], ref_imgs[i], to_grayscale=to_grayscale, tile_size=tile_size)
         res[i] = [synth_imgs_map[i], ref_imgs_map[i], ssim]
 
     df = pd.DataFrame.from_dict(data=res, orient='index', columns=['synth_img','ref_img','ssim'])
@@ -105,15 +177,16 @@ def calc_ssims(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_map:dict, to_
         
     return df
 
-def calc_ssims_best_match(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_map:dict, to_grayscale=None, save=True, output_dir='', filename='ssims_best_match.csv'):
+def calc_ssims_best_match(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_map:dict, to_grayscale=None, tile_size=None, save=True, output_dir='', filename='ssims_best_match.csv'):
     res = {}
 
     for i in range(len(synth_imgs)):
         best_match_img, best_match_ssim = None, 0.0
         print(f'synth img {i}')
+        synth_img = synth_imgs[i]
 
         for j in range(len(ref_imgs)):
-            ssim = utils.calc_ssim(synth_imgs[i], ref_imgs[j], to_grayscale=to_grayscale)
+            ssim = calc_ssim(synth_img, ref_imgs[j], to_grayscale=to_grayscale, tile_size=tile_size)
 
             if best_match_img is None or ssim > best_match_ssim:
                 best_match_img = ref_imgs_map[j]
@@ -128,6 +201,97 @@ def calc_ssims_best_match(synth_imgs, synth_imgs_map:dict, ref_imgs, ref_imgs_ma
         
     return df
 
+def calc_ssims_incremental(synth_img_paths, ref_img_paths, store:results_store.SSIMStore, to_grayscale=None, tile_size=None, save=True, output_dir='', filename='ssims.csv'):
+    """Incremental version of calc_ssims, only loading and calculating pairs missing from the store
+    """
+
+    if len(synth_img_paths) != len(ref_img_paths):
+        raise Exception(f'Unequal number of synthetic and reference images: {len(synth_img_paths)} and {len(ref_img_paths)}')
+
+    options = results_store.options_key(to_grayscale=to_grayscale)
+
+    res = {}
+
+    for i in range(len(ref_img_paths)):
+        synth_hash, ref_hash = results_store.hash_file(synth_img_paths[i]), results_store.hash_file(ref_img_paths[i])
+
+        ssim = store.get(synth_hash, ref_hash, options)
+        if ssim is None:
+            ssim = calc_ssim(load_image(synth_img_paths[i]), load_image(ref_img_paths[i]), to_grayscale=to_grayscale, tile_size=tile_size)
+            store.put_many([(synth_hash, ref_hash, ssim)], options)
+
+        res[i] = [os.path.basename(synth_img_paths[i]), os.path.basename(ref_img_paths[i]), ssim]
+
+    df = pd.DataFrame.from_dict(data=res, orient='index', columns=['synth_img','ref_img','ssim'])
+
+    if save:
+        df.to_csv(os.path.join(output_dir,filename))
+
+    return df
+
+def calc_ssims_best_match_incremental(synth_img_paths, ref_img_paths, store:results_store.SSIMStore, to_grayscale=None, tile_size=None, save=True, output_dir='', filename='ssims_best_match.csv'):
+    """Incremental version of calc_ssims_best_match
+
+    Each synthetic image is only compared against reference images it hasn't been compared against before,
+    and its best match is then the highest SSIM stored for the current reference images
+    """
+
+    options = results_store.options_key(to_grayscale=to_grayscale)
+
+    ref_hashes = [results_store.hash_file(path) for path in ref_img_paths]
+    ref_paths_by_hash = dict(zip(ref_hashes, ref_img_paths))
+    store.set_refs(ref_hashes)
+
+    ref_imgs = {} # lazily loaded, keyed by hash
+
+    res = {}
+
+    for i in range(len(synth_img_paths)):
+        synth_hash = results_store.hash_file(synth_img_paths[i])
+
+        missing = store.missing_refs(synth_hash, ref_hashes, options)
+        if missing:
+            print(f'synth img {i}: {len(missing)} new ref imgs')
+            synth_img = load_image(synth_img_paths[i])
+
+            rows = []
+            for ref_hash in missing:
+                if ref_hash not in ref_imgs:
+                    ref_imgs[ref_hash] = load_image(ref_paths_by_hash[ref_hash])
+                rows.append((synth_hash, ref_hash, calc_ssim(synth_img, ref_imgs[ref_hash], to_grayscale=to_grayscale, tile_size=tile_size)))
+
+            store.put_many(rows, options)
+
+        best_match_hash, best_match_ssim = store.best_match(synth_hash, options)
+        best_match_img = os.path.basename(ref_paths_by_hash[best_match_hash]) if best_match_hash is not None else None
+
+        res[i] = [os.path.basename(synth_img_paths[i]), best_match_img, best_match_ssim]
+
+    df = pd.DataFrame.from_dict(data=res, orient='index', columns=['synth_img','ref_img','ssim'])
+
+    if save:
+        df.to_csv(os.path.join(output_dir,filename))
+
+    return df
+
+def calc_intensity_stats(synth_img_paths, ref_img_paths, num_workers=1, save=True, output_dir='', filename='intensity_stats.csv'):
+    """Streams both image sets through grayscale intensity accumulators, one image at a time
+    """
+
+    accs = [
+        img_stats.accumulate_paths(synth_img_paths, num_workers=num_workers, name='synthetic'),
+        img_stats.accumulate_paths(ref_img_paths, num_workers=num_workers, name='reference'),
+        ]
+
+    df = pd.DataFrame([acc.summary() for acc in accs])
+
+    if save:
+        df.to_csv(os.path.join(output_dir,filename))
+        for acc in accs:
+            acc.save(os.path.join(output_dir, f'intensity_{acc.name}.npz'))
+
+    return accs, df
+
 def main():
     parser = get_args_parser()
 
@@ -141,9 +305,6 @@ def main():
 
     random.seed(args.seed)
 
-    synth_imgs, synth_imgs_map = load_images(args.synth_images_path, n_rand=args.use_n_rand_imgs)
-    ref_imgs, ref_imgs_map = load_images(args.ref_images_path, n_rand=args.use_n_rand_imgs)
-
     to_grayscale = None
     if args.grayscale_synth:
         to_grayscale = 'img1'
@@ -153,11 +314,47 @@ def main():
         else:
             to_grayscale = 'img2'
 
+    synth_img_paths = list_images(args.synth_images_path, n_rand=args.use_n_rand_imgs)
+    ref_img_paths = list_images(args.ref_images_path, n_rand=args.use_n_rand_imgs)
+
+    if args.intensity_hist:
+        # before SSIMs, which need whole images loaded and may reject the image sets
+        accs, intensity_stats = calc_intensity_stats(synth_img_paths, ref_img_paths, num_workers=args.num_workers, output_dir=args.output_dir)
+        print(intensity_stats)
+        viz.plot_intensity_histograms(accs, output_dir=args.output_dir)
+
+    calc_ssim_method = args.calc_ssim
+    if calc_ssim_method is None and not (args.intensity_hist and not args.ssim_hist and not args.ssim_boxplot):
+        calc_ssim_method = 'standard'
+
+    if calc_ssim_method is None:
+        return
+
     ssims = None
-    if args.calc_ssim == 'standard':
-        ssims = calc_ssims(synth_imgs, synth_imgs_map, ref_imgs, ref_imgs_map, to_grayscale=to_grayscale, output_dir=args.output_dir)
-    elif args.calc_ssim == 'best-match':
-        ssims = calc_ssims_best_match(synth_imgs, synth_imgs_map, ref_imgs, ref_imgs_map, to_grayscale=to_grayscale, output_dir=args.output_dir)
+    if args.results_store is not None:
+        with results_store.SSIMStore(args.results_store) as store:
+            if calc_ssim_method == 'standard':
+                ssims = calc_ssims_incremental(synth_img_paths, ref_img_paths, store, to_grayscale=to_grayscale, tile_size=args.ssim_tile_size, output_dir=args.output_dir)
+            elif calc_ssim_method == 'best-match':
+                ssims = calc_ssims_best_match_incremental(synth_img_paths, ref_img_paths, store, to_grayscale=to_grayscale, tile_size=args.ssim_tile_size, output_dir=args.output_dir)
+    else:
+        # when tiling, load each pair in turn so peak memory doesn't grow with the number of images
+        synth_imgs, synth_imgs_map = load_images(synth_img_paths, lazy=args.ssim_tile_size is not None)
+        ref_imgs, ref_imgs_map = load_images(ref_img_paths, lazy=args.ssim_tile_size is not None)
+
+        if calc_ssim_method == 'standard':
+            ssims = calc_ssims(
+                synth_imgs, 
+                synth_imgs_map, 
+                ref_imgs, 
+                ref_imgs_map, 
+                to_grayscale=to_grayscale, 
+                tile_size=args.ssim_tile_size, 
+                heatmap_scale=args.ssim_heatmap_scale, 
+                output_dir=args.output_dir,
+                )
+        elif calc_ssim_method == 'best-match':
+            ssims = calc_ssims_best_match(synth_imgs, synth_imgs_map, ref_imgs, ref_imgs_map, to_grayscale=to_grayscale, tile_size=args.ssim_tile_size, output_dir=args.output_dir)
 
     print(ssims)
 
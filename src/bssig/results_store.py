@@ -0,0 +1,105 @@
+"""Module for persistently storing image validation results
+SSIMs are keyed by content hashes of both images and the preprocessing options, so repeated
+validation runs only need to calculate the pairs that aren't already in the store
+"""
+
+import hashlib
+import json
+import sqlite3
+
+def hash_file(filepath:str, chunk_size=1 << 20):
+    """Calculates the SHA-256 hash of a file's contents
+    """
+
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def options_key(**options):
+    """Canonical string for a set of preprocessing options
+    """
+
+    return json.dumps(options, sort_keys=True)
+
+class SSIMStore:
+    """SQLite backed store of SSIMs between pairs of images
+    """
+
+    def __init__(self, filepath:str):
+        self.conn = sqlite3.connect(filepath)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS ssims (
+                synth_hash TEXT NOT NULL,
+                ref_hash TEXT NOT NULL,
+                options TEXT NOT NULL,
+                ssim REAL NOT NULL,
+                PRIMARY KEY (synth_hash, ref_hash, options)
+            )
+            ''')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def set_refs(self, ref_hashes):
+        """Sets the current reference image set that missing_refs() and best_match() are restricted to
+        """
+
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS curr_refs (ref_hash TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM curr_refs')
+        self.conn.executemany('INSERT OR IGNORE INTO curr_refs VALUES (?)', [(h,) for h in ref_hashes])
+        self.conn.commit()
+
+    def get(self, synth_hash:str, ref_hash:str, options:str):
+        row = self.conn.execute(
+            'SELECT ssim FROM ssims WHERE synth_hash = ? AND ref_hash = ? AND options = ?',
+            (synth_hash, ref_hash, options),
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def put_many(self, rows, options:str):
+        """Stores (synth_hash, ref_hash, ssim) rows, committing them together
+        """
+
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO ssims VALUES (?, ?, ?, ?)',
+            [(synth_hash, ref_hash, options, ssim) for synth_hash, ref_hash, ssim in rows],
+            )
+        self.conn.commit()
+
+    def missing_refs(self, synth_hash:str, ref_hashes, options:str):
+        """Reference hashes (from the current set) that haven't been compared against a synthetic image yet
+        """
+
+        done = {row[0] for row in self.conn.execute(
+            '''SELECT s.ref_hash FROM ssims s JOIN curr_refs c ON s.ref_hash = c.ref_hash
+            WHERE s.synth_hash = ? AND s.options = ?''',
+            (synth_hash, options),
+            )}
+
+        return [h for h in ref_hashes if h not in done]
+
+    def best_match(self, synth_hash:str, options:str):
+        """Highest SSIM reference in the current set for a synthetic image
+
+        Returns:
+            (ref_hash, ssim), or (None, None) if no pairs are stored
+        """
+
+        row = self.conn.execute(
+            '''SELECT s.ref_hash, MAX(s.ssim) FROM ssims s JOIN curr_refs c ON s.ref_hash = c.ref_hash
+            WHERE s.synth_hash = ? AND s.options = ?''',
+            (synth_hash, options),
+            ).fetchone()
+
+        return (None, None) if row is None or row[0] is None else row
@@ -1,7 +1,13 @@
 import bpy
 import random
 import math
-from utils import CameraSettings, RenderSettings, SunSettings
+import numpy as np
+from scipy.stats import qmc
+from scipy.spatial.transform import Rotation
+from bpy_extras.object_utils import world_to_camera_view
+from mathutils import Vector
+from utils import CameraSettings, RenderSettings, SunSettings, FilterSettings
+import filter_nodes
 
 def import_object(obj_path:str):
     """Import a single 3D object into the current Blender scene
@@ -27,7 +33,7 @@ def import_object(obj_path:str):
 
     return imported_obj.name
     
-def setup_scene(scene_path:str, obj_path:str, camera_settings:CameraSettings, render_settings:RenderSettings, sun_settings:SunSettings):
+def setup_scene(scene_path:str, obj_path:str, camera_settings:CameraSettings, render_settings:RenderSettings, sun_settings:SunSettings, filter_settings:FilterSettings|None=None):
     """Loads the scene and imports an object
     """
     
@@ -42,6 +48,8 @@ def setup_scene(scene_path:str, obj_path:str, camera_settings:CameraSettings, re
     camera.constraints['Track To'].track_axis = camera_settings.track_axis
     camera.constraints['Track To'].up_axis = camera_settings.up_axis
 
+    camera_settings.view_names = setup_view_cameras(camera_settings)
+
     sun = bpy.data.objects[sun_settings.name]
     sun.constraints.new(type='TRACK_TO')
     sun.constraints['Track To'].target = bpy.data.objects['Earth'] # always point the sun towards the earth
@@ -66,12 +74,156 @@ def setup_scene(scene_path:str, obj_path:str, camera_settings:CameraSettings, re
             for device in bpy.context.preferences.addons["cycles"].preferences.devices:
                  if device.type == 'GPU':
                     device.use = True
+        if camera_settings.num_views > 1:
+            # keep synced scene data and BVHs between renders, so views that only move the camera skip rebuilding them
+            bpy.context.scene.render.use_persistent_data = True
     else:
         bpy.context.scene.render.engine = 'BLENDER_EEVEE_NEXT'
         bpy.context.scene.eevee.taa_render_samples = render_settings.num_render_samples
 
+    if render_settings.use_region_render:
+        setup_region_compositing(render_settings.background_image)
+
+    # filters go after the region background, so they apply to the whole frame
+    if filter_settings is not None and filter_settings.any_enabled():
+        filter_nodes.setup_filter_compositing(filter_settings, render_settings)
+
     return obj_name
 
+def setup_view_cameras(camera_settings:CameraSettings):
+    """Creates extra tracking cameras so each pose can be rendered from several views
+
+    Extra cameras are copies of the configured camera, so they share its lens and Track To setup
+
+    Returns:
+        names of all the view cameras, starting with the configured camera
+    """
+
+    camera = bpy.data.objects[camera_settings.name]
+    view_names = [camera.name]
+
+    for k in range(1, camera_settings.num_views):
+        view_camera = camera.copy()
+        view_camera.data = camera.data.copy()
+        view_camera.name = f'{camera_settings.name}.view{k}'
+        bpy.context.scene.collection.objects.link(view_camera)
+        view_names.append(view_camera.name)
+
+    return view_names
+
+def setup_region_compositing(background_path:str|None=None):
+    """Composites the render over a background using compositor nodes
+
+    Pixels outside the render region are left empty by Blender, so alpha-overing the render onto
+    a cached background image (or analytically black if unspecified) fills in the rest of the frame.
+    The world is rendered transparent everywhere, so the whole frame's background comes from that one
+    source rather than the world showing only inside the region
+    """
+
+    scene = bpy.context.scene
+    scene.render.film_transparent = True
+    scene.use_nodes = True
+    tree = scene.node_tree
+
+    rlayers = next((node for node in tree.nodes if node.type == 'R_LAYERS'), None) or tree.nodes.new('CompositorNodeRLayers')
+    composite = next((node for node in tree.nodes if node.type == 'COMPOSITE'), None) or tree.nodes.new('CompositorNodeComposite')
+
+    # keep any existing compositing, inserting the alpha over right before the output
+    if composite.inputs['Image'].is_linked:
+        fg_socket = composite.inputs['Image'].links[0].from_socket
+    else:
+        fg_socket = rlayers.outputs['Image']
+
+    if background_path is not None:
+        bg = tree.nodes.new('CompositorNodeImage')
+        bg.image = bpy.data.images.load(background_path)
+        scale = tree.nodes.new('CompositorNodeScale')
+        scale.space = 'RENDER_SIZE'
+        scale.frame_method = 'STRETCH'
+        tree.links.new(bg.outputs['Image'], scale.inputs['Image'])
+        bg_socket = scale.outputs['Image']
+    else:
+        bg = tree.nodes.new('CompositorNodeRGB')
+        bg.outputs[0].default_value = (0.0, 0.0, 0.0, 1.0)
+        bg_socket = bg.outputs[0]
+
+    alpha_over = tree.nodes.new('CompositorNodeAlphaOver')
+    tree.links.new(bg_socket, alpha_over.inputs[1])
+    tree.links.new(fg_socket, alpha_over.inputs[2])
+    tree.links.new(alpha_over.outputs['Image'], composite.inputs['Image'])
+
+def get_screen_bbox(obj_name:str, camera_name='Camera'):
+    """Projects an object's bounding box into the camera's view
+
+    Returns:
+        normalized (min_x, min_y, max_x, max_y) of the bounding box in the frame, origin at the bottom left,
+        or None if part of the bounding box is behind the camera
+    """
+
+    scene = bpy.context.scene
+    obj, camera = bpy.data.objects[obj_name], bpy.data.objects[camera_name]
+
+    coords = [world_to_camera_view(scene, camera, obj.matrix_world @ Vector(corner)) for corner in obj.bound_box]
+
+    if any(coord.z <= 0.0 for coord in coords):
+        return None
+
+    xs, ys = [coord.x for coord in coords], [coord.y for coord in coords]
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+def is_in_view(obj_name:str, camera_name='Camera'):
+    """Conservatively checks whether any of an object's bounding box could be in the camera's view
+    """
+
+    obj, camera = bpy.data.objects[obj_name], bpy.data.objects[camera_name]
+
+    if all((obj.matrix_world @ Vector(corner) - camera.matrix_world.translation).dot(camera.matrix_world.to_3x3().col[2]) > 0.0 for corner in obj.bound_box):
+        return False # entirely behind the camera, which looks down its -z axis
+
+    bbox = get_screen_bbox(obj_name, camera_name=camera_name)
+    if bbox is None:
+        return True # straddles the camera plane
+
+    min_x, min_y, max_x, max_y = bbox
+
+    return max_x >= 0.0 and min_x <= 1.0 and max_y >= 0.0 and min_y <= 1.0
+
+def set_render_region(obj_name:str, camera_name='Camera', margin=0.05):
+    """Restricts rendering to the object's screen space region, padded by a margin
+
+    Falls back to rendering the full frame if any other renderable geometry (e.g. the Earth) could be
+    in view, or the object's region can't be determined
+
+    Returns:
+        whether a region render was set
+    """
+
+    render = bpy.context.scene.render
+
+    # make sure constraints and transforms reflect the current pose
+    bpy.context.view_layer.update()
+
+    others_in_view = any(
+        is_in_view(obj.name, camera_name=camera_name) 
+        for obj in bpy.context.scene.objects 
+        if obj.type == 'MESH' and obj.name != obj_name and not obj.hide_render
+        )
+    bbox = get_screen_bbox(obj_name, camera_name=camera_name)
+
+    if others_in_view or bbox is None:
+        render.use_border = False
+        return False
+
+    min_x, min_y, max_x, max_y = bbox
+
+    render.use_border = True
+    render.use_crop_to_border = False
+    render.border_min_x, render.border_min_y = max(min_x-margin, 0.0), max(min_y-margin, 0.0)
+    render.border_max_x, render.border_max_y = min(max_x+margin, 1.0), min(max_y+margin, 1.0)
+
+    return True
+
 def set_sun_pos(dist_from_origin:float, angle:float, sun_name='Sun'):
     """Set the sun's position on the ecliptic plane
     
@@ -142,6 +294,138 @@ def rand_cartesian_coords(min_val:float, max_val:float):
 
     return [x,y,z]
 
+def unit_to_sphere(u:float, v:float):
+    """Maps a point in the unit square to a direction uniformly distributed on the unit sphere
+
+    Uses z = cos(phi) rather than phi itself, so equal areas of the square map to equal areas of the sphere
+    """
+
+    z = 1.0 - 2.0 * u
+    theta = 2.0 * math.pi * v
+    r = math.sqrt(max(0.0, 1.0 - z*z))
+
+    return [r * math.cos(theta), r * math.sin(theta), z]
+
+def sample_unit_cube(num_samples:int, num_dims:int, method='sobol', seed=None):
+    """Samples points in the unit hypercube
+
+    Args:
+        method: sobol for scrambled Sobol, stratified for Latin hypercube, random for independent uniform samples
+    """
+
+    if method == 'sobol':
+        sampler = qmc.Sobol(d=num_dims, scramble=True, seed=seed)
+        # draw a balanced power of 2 sized sequence and keep its prefix
+        return sampler.random_base2(m=max(0, math.ceil(math.log2(max(num_samples, 1)))))[:num_samples]
+    elif method == 'stratified':
+        return qmc.LatinHypercube(d=num_dims, seed=seed).random(num_samples)
+    elif method == 'random':
+        return np.random.default_rng(seed).random((num_samples, num_dims))
+    else:
+        raise Exception('Invalid sampling method - supported methods are sobol, stratified, random')
+
+def sphere_coverage(dirs:np.ndarray, num_cells=None):
+    """Fraction of equal-area cells on the unit sphere containing at least one direction
+
+    Cells are bands of equal height in z split evenly around the z axis. Defaults to about one cell per direction
+    """
+
+    dirs = np.asarray(dirs, dtype=np.float64)
+    if num_cells is None:
+        num_cells = len(dirs)
+
+    num_bands = max(1, int(math.sqrt(num_cells / 2)))
+    num_sectors = 2 * num_bands
+
+    bands = np.clip(((1.0 - dirs[:, 2]) / 2.0 * num_bands).astype(np.int64), 0, num_bands-1)
+    sectors = np.clip((np.mod(np.arctan2(dirs[:, 1], dirs[:, 0]), 2*math.pi) / (2*math.pi) * num_sectors).astype(np.int64), 0, num_sectors-1)
+
+    return len(np.unique(bands * num_sectors + sectors)) / (num_bands * num_sectors)
+
+def unit_to_rotation(u1:float, u2:float, u3:float):
+    """Maps a point in the unit cube to a rotation uniformly distributed over all orientations
+
+    Uses Shoemake's uniform quaternion construction, then converts to Blender's XYZ Euler angles (radians)
+    """
+
+    a, b = math.sqrt(1.0 - u1), math.sqrt(u1)
+    quat = [a * math.sin(2*math.pi*u2), a * math.cos(2*math.pi*u2), b * math.sin(2*math.pi*u3), b * math.cos(2*math.pi*u3)]
+
+    # extrinsic xyz, i.e. Z @ Y @ X, is Blender's XYZ Euler order
+    return Rotation.from_quat(quat).as_euler('xyz').tolist()
+
+class PoseSampler:
+    """Jointly samples object rotations, camera directions and distances, and sun angles
+
+    Poses are drawn up front as one low-discrepancy sequence over the joint space, so a given coverage
+    takes fewer renders than independent uniform samples. Camera directions are uniform on the sphere.
+    Object rotations are uniform over all orientations when the rotation range spans a full turn on every axis,
+    otherwise uniform Euler angles within the range are used, since a uniform rotation can't honour a restricted range
+    """
+
+    # joint discrepancy is O(n^2), so above this only a prefix of the samples is measured
+    MAX_DISCREPANCY_SAMPLES = 8192
+
+    # unit cube dimensions: object x, y, z rotation, camera direction (2), camera distance, sun angle,
+    # then direction (2) and distance for each extra view
+    NUM_DIMS = 7
+
+    def __init__(self, num_samples:int, min_object_rot, max_object_rot, min_camera_dist:float, max_camera_dist:float, num_views=1, method='sobol', seed=None):
+        self.method = method
+        self.num_views = num_views
+        self.min_object_rot, self.max_object_rot = min_object_rot, max_object_rot
+        self.min_camera_dist, self.max_camera_dist = min_camera_dist, max_camera_dist
+        self.uniform_rotation = all(hi - lo >= 2*math.pi for lo, hi in zip(min_object_rot, max_object_rot))
+        self.samples = sample_unit_cube(num_samples, self.NUM_DIMS + 3*(num_views-1), method=method, seed=seed)
+
+    def _camera_dims(self, view:int):
+        return 3 if view == 0 else self.NUM_DIMS + 3*(view-1)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def object_rot(self, i:int):
+        if self.uniform_rotation:
+            return unit_to_rotation(*self.samples[i, 0:3])
+
+        return [lo + u*(hi-lo) for u, lo, hi in zip(self.samples[i, 0:3], self.min_object_rot, self.max_object_rot)]
+
+    def camera_dir(self, i:int, view=0):
+        d = self._camera_dims(view)
+
+        return unit_to_sphere(self.samples[i, d], self.samples[i, d+1])
+
+    def camera_xyz(self, i:int, view=0):
+        d = self._camera_dims(view)
+        dist = self.min_camera_dist + self.samples[i, d+2]*(self.max_camera_dist-self.min_camera_dist)
+
+        return [dist*c for c in self.camera_dir(i, view=view)]
+
+    def sun_angle(self, i:int):
+        return 2 * math.pi * self.samples[i, 6]
+
+    def coverage(self):
+        """Coverage metrics of the sampled poses
+
+        Returns:
+            view_sphere_coverage - fraction of equal-area view sphere cells hit by a camera direction, higher is better
+
+            joint_discrepancy - centered L2 discrepancy of the joint samples, lower is better. Measured on the first
+            discrepancy_num_samples samples, capped at MAX_DISCREPANCY_SAMPLES
+        """
+
+        dirs = [self.camera_dir(i, view=view) for i in range(len(self)) for view in range(self.num_views)]
+        discrepancy_samples = self.samples[:self.MAX_DISCREPANCY_SAMPLES]
+
+        return {
+            'method': self.method,
+            'num_samples': len(self),
+            'uniform_rotation': self.uniform_rotation,
+            'view_sphere_coverage': sphere_coverage(dirs),
+            'joint_discrepancy': float(qmc.discrepancy(discrepancy_samples)) if len(discrepancy_samples) > 1 else None,
+            'discrepancy_num_samples': len(discrepancy_samples),
+        }
+
 def rand_set_sun_pos(dist_from_origin:float, sun_name='Sun'):
     """Randomly set the sun's position along the ecliptic plane
     """
@@ -4,6 +4,7 @@ import sys
 import filters
 import numpy as np
 from skimage import img_as_float
+from skimage.measure import block_reduce
 from skimage.metrics import structural_similarity as ssim
 from dataclasses import dataclass
 
@@ -13,6 +14,8 @@ class CameraSettings:
     focal_len = 50.0
     track_axis = 'TRACK_NEGATIVE_Z'
     up_axis = 'UP_Y'
+    num_views = 1
+    view_names = None
 
 @dataclass
 class RenderSettings:
@@ -24,6 +27,9 @@ class RenderSettings:
     cycles_device_type = None
     use_gpu = False
     num_render_samples = 200
+    use_region_render = False
+    region_margin = 0.05
+    background_image = None
 
 @dataclass
 class SunSettings:
@@ -31,11 +37,34 @@ class SunSettings:
     track_axis = 'TRACK_NEGATIVE_Z'
     up_axis = 'UP_Y'
 
+@dataclass
+class FilterSettings:
+    gaussian_blur_sigma = None
+    noise_std = None
+    noise_mean = 0.0
+    grayscale = False
+    glow_threshold = None
+    glow_size = 8
+    motion_blur_length = None
+    motion_blur_angle = 0.0
+    lens_flare_threshold = None
+    lens_flare_ghosts = 4
+
+    def any_enabled(self):
+        return any([
+            self.gaussian_blur_sigma is not None,
+            self.noise_std is not None,
+            self.grayscale,
+            self.glow_threshold is not None,
+            self.motion_blur_length is not None,
+            self.lens_flare_threshold is not None,
+            ])
     
 def parser_camera_settings(args):
     camera_settings = CameraSettings()
 
     camera_settings.focal_len = args.focal_len
+    camera_settings.num_views = args.num_views
     
     return camera_settings
 
@@ -44,11 +73,14 @@ def parse_render_settings(args):
 
     render_settings.num_horiz_pixels = args.num_horiz_pixels
     render_settings.num_vert_pixels = args.num_vert_pixels
-    render_settings.use_cylces = args.use_cycles
+    render_settings.use_cycles = args.use_cycles
     render_settings.cycles_experimental = args.cycles_experimental
     render_settings.cycles_device_type = args.cycles_device_type
     render_settings.use_gpu = args.use_gpu
     render_settings.num_render_samples = args.num_render_samples
+    render_settings.use_region_render = args.region_render
+    render_settings.region_margin = args.region_margin
+    render_settings.background_image = args.background_image
 
     return render_settings
 
@@ -57,6 +89,22 @@ def parse_sun_settings(args):
 
     return sun_settings
     
+def parse_filter_settings(args):
+    filter_settings = FilterSettings()
+
+    filter_settings.gaussian_blur_sigma = args.gaussian_blur
+    filter_settings.noise_std = args.gaussian_noise
+    filter_settings.noise_mean = args.noise_mean
+    filter_settings.grayscale = args.grayscale
+    filter_settings.glow_threshold = args.fog_glow
+    filter_settings.glow_size = args.glow_size
+    filter_settings.motion_blur_length = args.motion_blur
+    filter_settings.motion_blur_angle = args.motion_blur_angle
+    filter_settings.lens_flare_threshold = args.lens_flare
+    filter_settings.lens_flare_ghosts = args.lens_flare_ghosts
+
+    return filter_settings
+    
 def mkdir(path):
     try:
         os.makedirs(path)
@@ -77,17 +125,7 @@ def get_script_args():
 
     return argv
 
-def calc_ssim(img1:np.ndarray, img2:np.ndarray, to_grayscale='both'):
-    """Calculates the Structural Similarity Index (SSIM) between 2 images
-
-    Args:
-        img1: matrix representation of 1st image
-
-        img2: matrix representation of 2nd image
-
-        to_grayscale: convert 1, both, or none of the images to grayscale, otherwise assume they're already grayscale
-    """
-
+def _to_ssim_imgs(img1:np.ndarray, img2:np.ndarray, to_grayscale='both'):
     # normalize pixel values to be in range 0-1
     img1 = img_as_float(img1)
     img2 = img_as_float(img2)
@@ -103,5 +141,92 @@ def calc_ssim(img1:np.ndarray, img2:np.ndarray, to_grayscale='both'):
         else:
             raise Exception('Invalid value for to_grayscale - support values are None, img1, img2')
 
+    return img1, img2
+
+def calc_ssim(img1:np.ndarray, img2:np.ndarray, to_grayscale='both'):
+    """Calculates the Structural Similarity Index (SSIM) between 2 images
+
+    Args:
+        img1: matrix representation of 1st image
+
+        img2: matrix representation of 2nd image
+
+        to_grayscale: convert 1, both, or none of the images to grayscale, otherwise assume they're already grayscale
+    """
+
+    img1, img2 = _to_ssim_imgs(img1, img2, to_grayscale=to_grayscale)
+
     return ssim(img1, img2, data_range=1.0)
 
+def calc_ssim_tiled(img1:np.ndarray, img2:np.ndarray, to_grayscale='both', tile_size=512, heatmap_scale=None, win_size=7):
+    """Calculates the SSIM between 2 images one tile at a time
+
+    Each tile is extended by a halo of half the SSIM window, so every pixel's local SSIM is the same as in the full-image
+    calculation and the mean over the same valid region as calc_ssim is returned. Only one tile's float intermediates
+    are held at a time, so peak memory scales with tile_size rather than image size
+
+    Args:
+        img1: matrix representation of 1st image
+
+        img2: matrix representation of 2nd image
+
+        to_grayscale: convert 1, both, or none of the images to grayscale, otherwise assume they're already grayscale
+
+        tile_size: height and width of the tiles, excluding the halo
+
+        heatmap_scale: if specified, also return the per-pixel SSIM map block-averaged down by this factor
+
+        win_size: side length of the SSIM sliding window
+    """
+
+    if img1.shape[:2] != img2.shape[:2]:
+        raise Exception(f'Images must have the same dimensions: {img1.shape[:2]} and {img2.shape[:2]}')
+
+    if heatmap_scale is not None:
+        # keep tiles aligned with heatmap blocks
+        tile_size = -(-tile_size // heatmap_scale) * heatmap_scale
+
+    height, width = img1.shape[:2]
+    pad = (win_size - 1) // 2
+
+    ssim_sum, ssim_count = 0.0, 0
+    if heatmap_scale is not None:
+        heatmap_shape = (-(-height // heatmap_scale), -(-width // heatmap_scale))
+        heatmap_sums, heatmap_counts = np.zeros(heatmap_shape), np.zeros(heatmap_shape)
+
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1, x1 = min(y0+tile_size, height), min(x0+tile_size, width)
+
+            # tile plus halo, clipped to the image
+            hy0, hx0 = max(y0-pad, 0), max(x0-pad, 0)
+            hy1, hx1 = min(y1+pad, height), min(x1+pad, width)
+            # narrow edge tiles need at least one full window of context
+            hy1, hx1 = min(max(hy1, hy0+win_size), height), min(max(hx1, hx0+win_size), width)
+            hy0, hx0 = max(min(hy0, hy1-win_size), 0), max(min(hx0, hx1-win_size), 0)
+
+            tile1, tile2 = _to_ssim_imgs(img1[hy0:hy1, hx0:hx1], img2[hy0:hy1, hx0:hx1], to_grayscale=to_grayscale)
+            _, ssim_map = ssim(tile1, tile2, data_range=1.0, win_size=win_size, full=True)
+            core = ssim_map[y0-hy0:y1-hy0, x0-hx0:x1-hx0]
+
+            # only pixels at least pad away from the image border count towards the mean, as in calc_ssim
+            vy0, vx0 = max(y0, pad), max(x0, pad)
+            vy1, vx1 = min(y1, height-pad), min(x1, width-pad)
+            if vy1 > vy0 and vx1 > vx0:
+                valid = core[vy0-y0:vy1-y0, vx0-x0:vx1-x0]
+                ssim_sum += float(valid.sum(dtype=np.float64))
+                ssim_count += valid.size
+
+            if heatmap_scale is not None:
+                by, bx = y0 // heatmap_scale, x0 // heatmap_scale
+                blocks = block_reduce(core, (heatmap_scale, heatmap_scale), np.sum, cval=0.0)
+                counts = block_reduce(np.ones(core.shape), (heatmap_scale, heatmap_scale), np.sum, cval=0.0)
+                heatmap_sums[by:by+blocks.shape[0], bx:bx+blocks.shape[1]] += blocks
+                heatmap_counts[by:by+counts.shape[0], bx:bx+counts.shape[1]] += counts
+
+    res = ssim_sum / ssim_count
+
+    if heatmap_scale is not None:
+        return res, heatmap_sums / heatmap_counts
+
+    return res
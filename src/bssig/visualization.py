@@ -1,22 +1,50 @@
-import filters
+import argparse
 import os
+import skimage
 import pandas as pd
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from multiprocessing import Pool
+from skimage import img_as_ubyte
+
+import img_stats
+import utils
+
+def calc_img_histogram(img:np.ndarray, to_grayscale=True, bins=256):
+    """Calculates the pixel intensity histogram of an image
+
+    Intensities are quantized to uint8 and counted with an integer bincount, which is much faster than binning floats.
+    The number of bins must evenly divide 256, so every bin covers the same number of intensity levels
+
+    Returns:
+        counts and bin edges (in range 0-1) of the histogram
+    """
+
+    if bins <= 0 or 256 % bins != 0:
+        raise Exception(f'Invalid number of bins {bins} - must evenly divide 256')
+
+    img = img_stats.to_intensity(img, to_grayscale=to_grayscale)
+
+    counts = np.bincount(img_as_ubyte(np.clip(img, 0.0, 1.0)).ravel(), minlength=256)
+    counts = counts.reshape(bins, 256 // bins).sum(axis=1)
+
+    return counts, np.linspace(0.0, 1.0, bins+1)
 
 def plot_img_histogram(img:np.ndarray, to_grayscale=True, title='Image Histogram', log_scale=True, save=True, show=False, output_dir='', filename='img_hist'):
     """Plots the pixel intensity histogram of an image
     """
-    
-    if to_grayscale:
-        img = filters.apply_grayscale(img)
 
-    plt.hist(img.flatten(), bins=256, range=(0.0, 1.0), log=log_scale)
+    counts, edges = calc_img_histogram(img, to_grayscale=to_grayscale)
+
+    plt.stairs(counts, edges, fill=True)
+
+    if log_scale:
+        plt.yscale('log')
 
     cbar = plt.colorbar(mpl.cm.ScalarMappable(
         norm=mpl.colors.Normalize(0,1), 
-        cmap=mpl.cm.get_cmap('gray', 256)), 
+        cmap=mpl.colormaps['gray'].resampled(256)), 
         ax=plt.gca(),
         )
     cbar.set_label('Grayscale Intensity')
@@ -33,6 +61,39 @@ def plot_img_histogram(img:np.ndarray, to_grayscale=True, title='Image Histogram
 
     plt.close()
 
+def _use_agg_backend():
+    mpl.use('Agg')
+
+def _plot_img_histogram_file(img_path:str, to_grayscale=True, log_scale=True, output_dir=''):
+    filename = f'{os.path.splitext(os.path.basename(img_path))[0]}_hist'
+    plot_img_histogram(
+        skimage.io.imread(img_path), 
+        to_grayscale=to_grayscale, 
+        title=os.path.basename(img_path), 
+        log_scale=log_scale, 
+        output_dir=output_dir, 
+        filename=filename,
+        )
+
+    return os.path.join(output_dir, filename)
+
+def plot_img_histograms_dir(filepath:str, to_grayscale=True, log_scale=True, num_workers=1, output_dir=''):
+    """Plots the pixel intensity histogram of every image in a directory
+
+    Plots are drawn on the non-interactive Agg backend, and spread across a process pool if num_workers > 1
+    """
+
+    img_paths = sorted([entry.path for entry in os.scandir(filepath) if entry.is_file()])
+    tasks = [(path, to_grayscale, log_scale, output_dir) for path in img_paths]
+
+    _use_agg_backend()
+
+    if num_workers <= 1:
+        return [_plot_img_histogram_file(*task) for task in tasks]
+
+    with Pool(processes=num_workers, initializer=_use_agg_backend) as pool:
+        return pool.starmap(_plot_img_histogram_file, tasks, chunksize=max(1, len(tasks) // (num_workers*4)))
+
 def plot_ssim_histogram(ssims:pd.DataFrame, bins:str|int|None=None, title='SSIM Scores Histogram', save=True, show=False, output_dir='', filename='ssim_hist'):
     plt.hist(ssims['ssim'], bins=bins, color='red', edgecolor='black')
     plt.title(title)
@@ -58,4 +119,97 @@ def plot_ssim_boxplot(ssims:pd.DataFrame, title='SSIM Scores Boxplot', save=True
     if show:
         plt.show()
 
-    plt.close()
\ No newline at end of file
+    plt.close()
+
+def plot_intensity_histograms(accumulators:list, log_scale=True, title='Dataset Intensity Histograms', save=True, show=False, output_dir='', filename='intensity_hist'):
+    """Plots the normalized pixel intensity histograms of one or more datasets on shared axes
+
+    Args:
+        accumulators: list of img_stats.IntensityAccumulator, one per dataset
+    """
+
+    for acc in accumulators:
+        density = acc.density()
+        edges = np.linspace(0.0, 1.0, len(density)+1)
+        plt.stairs(density, edges, label=f'{acc.name} (mean={acc.mean:.3f}, std={acc.std:.3f})')
+
+    if log_scale:
+        plt.yscale('log')
+
+    plt.title(title)
+    plt.xlabel('Pixel Intensity')
+    plt.ylabel('Pixel Density')
+    plt.legend()
+    
+    if save:
+        plt.savefig(os.path.join(output_dir,filename))
+
+    if show:
+        plt.show()
+
+    plt.close()
+
+
+def plot_ssim_heatmap(ssim_map:np.ndarray, title='SSIM Map', save=True, show=False, output_dir='', filename='ssim_heatmap'):
+    """Plots a (typically downsampled) per-pixel SSIM map to help localize artifacts
+    """
+
+    plt.imshow(ssim_map, cmap='viridis', vmin=min(0.0, float(np.nanmin(ssim_map))), vmax=1.0)
+
+    cbar = plt.colorbar()
+    cbar.set_label('SSIM Score')
+
+    plt.title(title)
+    plt.axis('off')
+
+    if save:
+        plt.savefig(os.path.join(output_dir,filename))
+
+    if show:
+        plt.show()
+
+    plt.close()
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Batch Image Histogram Plotting', add_help=True)
+
+    parser.add_argument(
+        'images_path',
+        metavar='images-path',
+        type=str,
+        help='Path to images to plot histograms of.',
+        )
+
+    parser.add_argument('--no-grayscale', action='store_true', help='Plot intensities of every channel instead of converting to grayscale.',)
+
+    parser.add_argument('--linear-scale', action='store_true', help='Use a linear rather than log scale for pixel frequencies.',)
+
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of processes to plot with.',)
+
+    parser.add_argument(
+        '--output-dir', 
+        type=str, 
+        default='', 
+        help='Path to directory to save plots to, or current working directory if not specified.',
+        )
+
+    return parser
+
+def main():
+    parser = get_args_parser()
+
+    args = parser.parse_args()
+
+    if args.output_dir != '':
+        utils.mkdir(args.output_dir)
+
+    plot_img_histograms_dir(
+        args.images_path, 
+        to_grayscale=not args.no_grayscale, 
+        log_scale=not args.linear_scale, 
+        num_workers=args.num_workers, 
+        output_dir=args.output_dir,
+        )
+
+if __name__ == '__main__':
+    main()
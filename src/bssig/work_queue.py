@@ -0,0 +1,316 @@
+"""Module for distributing image generation across nodes sharing a filesystem
+A job is split into chunks of frames, which workers claim with file based leases that expire,
+so chunks held by crashed workers are reclaimed by others. No scheduler or server is needed
+
+Job directory layout:
+    job.json - job settings
+    leases/chunk{c}.{gen} - lease on chunk c, where each reclaim of an expired lease creates the next generation
+    done/chunk{c} - marks chunk c as finished
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import time
+
+def _job_file(job_dir:str):
+    return os.path.join(job_dir, 'job.json')
+
+def _lease_path(job_dir:str, chunk:int, gen:int):
+    return os.path.join(job_dir, 'leases', f'chunk{chunk}.{gen}')
+
+def _done_path(job_dir:str, chunk:int):
+    return os.path.join(job_dir, 'done', f'chunk{chunk}')
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def create_job(job_dir:str, num_images:int, chunk_size:int, lease_secs=600.0, seed=None, **settings):
+    """Writes a job of num_images frames split into chunks of chunk_size frames
+
+    Any extra settings are stored in the job for workers to read
+    """
+
+    if chunk_size <= 0:
+        raise Exception('Chunk size must be positive')
+
+    os.makedirs(os.path.join(job_dir, 'leases'), exist_ok=True)
+    os.makedirs(os.path.join(job_dir, 'done'), exist_ok=True)
+
+    if os.path.exists(_job_file(job_dir)):
+        raise Exception(f'{job_dir} already contains a job')
+
+    job = {
+        'num_images': num_images,
+        'chunk_size': chunk_size,
+        'num_chunks': -(-num_images // chunk_size),
+        'lease_secs': lease_secs,
+        'seed': seed if seed is not None else random.randrange(2**31), # every worker must agree on the seed
+        **settings,
+    }
+
+    # write then rename, so workers never see a partial job file
+    tmp_path = f'{_job_file(job_dir)}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, _job_file(job_dir))
+
+    return job
+
+def load_job(job_dir:str):
+    with open(_job_file(job_dir)) as f:
+        return json.load(f)
+
+def chunk_images(job:dict, chunk:int):
+    """Indices of the images in a chunk
+    """
+
+    return range(chunk*job['chunk_size'], min((chunk+1)*job['chunk_size'], job['num_images']))
+
+def is_done(job_dir:str, chunk:int):
+    return os.path.exists(_done_path(job_dir, chunk))
+
+def _lease_gens(job_dir:str):
+    gens = {}
+    for filename in os.listdir(os.path.join(job_dir, 'leases')):
+        name, _, gen = filename.partition('.')
+        if name.startswith('chunk') and gen.isdigit():
+            chunk = int(name[len('chunk'):])
+            gens[chunk] = max(gens.get(chunk, -1), int(gen))
+
+    return gens
+
+def _read_lease(job_dir:str, job:dict, chunk:int, gen:int):
+    path = _lease_path(job_dir, chunk, gen)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        # leases are always written whole, but fall back to the file's age if one is ever corrupted
+        try:
+            return {'worker': None, 'expires': os.path.getmtime(path) + job['lease_secs']}
+        except FileNotFoundError:
+            return None
+
+def _write_lease(path:str, worker_id:str, lease_secs:float, exclusive:bool):
+    lease = json.dumps({'worker': worker_id, 'expires': time.time() + lease_secs})
+
+    # write to a tmp file first, so the lease appears with its contents in one step
+    tmp_path = f'{path}.{worker_id}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(lease)
+
+    if exclusive:
+        # link fails if the lease exists, so only one worker can claim each lease generation
+        try:
+            os.link(tmp_path, path)
+        finally:
+            os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+def claim_chunk(job_dir:str, job:dict, worker_id:str):
+    """Claims the first chunk that isn't done and is unleased or has an expired lease
+
+    Returns:
+        (chunk, lease generation), or None if no chunk can currently be claimed
+    """
+
+    gens = _lease_gens(job_dir)
+
+    for chunk in range(job['num_chunks']):
+        if is_done(job_dir, chunk):
+            continue
+
+        gen = gens.get(chunk)
+        if gen is not None:
+            lease = _read_lease(job_dir, job, chunk, gen)
+            if lease is None or lease['expires'] > time.time():
+                continue
+            gen += 1
+        else:
+            gen = 0
+
+        try:
+            _write_lease(_lease_path(job_dir, chunk, gen), worker_id, job['lease_secs'], exclusive=True)
+        except FileExistsError:
+            continue # another worker got there first
+
+        return chunk, gen
+
+    return None
+
+def renew_lease(job_dir:str, job:dict, chunk:int, gen:int, worker_id:str):
+    """Extends a held lease
+
+    Returns:
+        whether the lease is still held, i.e. it hasn't been reclaimed by another worker
+    """
+
+    if _lease_gens(job_dir).get(chunk, gen) != gen:
+        return False
+
+    _write_lease(_lease_path(job_dir, chunk, gen), worker_id, job['lease_secs'], exclusive=False)
+
+    return True
+
+def mark_done(job_dir:str, chunk:int, worker_id:str):
+    with open(_done_path(job_dir, chunk), 'w') as f:
+        f.write(worker_id)
+
+def num_done(job_dir:str, job:dict):
+    return sum(is_done(job_dir, chunk) for chunk in range(job['num_chunks']))
+
+def run_worker(job_dir:str, render_fn, worker_id=None, on_chunk_start=None, poll_secs=10.0):
+    """Claims and renders chunks until every chunk in the job is done
+
+    Rendering is assumed to be deterministic per image, so if a slow worker's lease is reclaimed,
+    both workers render the same frames and either result can be kept
+
+    Args:
+        render_fn: called with the index of each image to render
+
+        on_chunk_start: if specified, called with the chunk index before its images are rendered, e.g. to seed RNGs
+
+        poll_secs: how long to wait before retrying when every remaining chunk is leased by another worker
+    """
+
+    job = load_job(job_dir)
+    worker_id = worker_id if worker_id is not None else default_worker_id()
+
+    while num_done(job_dir, job) < job['num_chunks']:
+        claim = claim_chunk(job_dir, job, worker_id)
+        if claim is None:
+            time.sleep(poll_secs)
+            continue
+
+        chunk, gen = claim
+        print(f'{worker_id} claimed chunk {chunk} (lease {gen})')
+
+        if on_chunk_start is not None:
+            on_chunk_start(chunk)
+
+        for i in chunk_images(job, chunk):
+            render_fn(i)
+            if not renew_lease(job_dir, job, chunk, gen, worker_id):
+                print(f'{worker_id} lost lease on chunk {chunk}, finishing anyway')
+
+        mark_done(job_dir, chunk, worker_id)
+
+def _simulated_render(job_dir:str, worker_id:str, render_secs:float, i:int):
+    time.sleep(render_secs)
+    with open(os.path.join(job_dir, 'out', f'img{i}'), 'a') as f:
+        f.write(f'{worker_id}\n')
+
+def _simulated_worker(job_dir:str, worker_id:str, render_secs:float, poll_secs:float):
+    run_worker(job_dir, lambda i: _simulated_render(job_dir, worker_id, render_secs, i), worker_id=worker_id, poll_secs=poll_secs)
+
+def _simulated_crash(job_dir:str, worker_id:str, render_secs:float):
+    # claim a chunk and render part of it, then die without marking it done
+    job = load_job(job_dir)
+    claim = claim_chunk(job_dir, job, worker_id)
+    if claim is not None:
+        _simulated_render(job_dir, worker_id, render_secs, chunk_images(job, claim[0])[0])
+        print(f'{worker_id} crashed holding chunk {claim[0]}')
+    os._exit(1)
+
+def simulate(job_dir:str, num_workers:int, num_images=100, chunk_size=10, lease_secs=2.0, render_secs=0.01, num_crashes=1):
+    """Runs a job on this machine with worker processes rendering dummy images, some of which crash mid chunk
+
+    Returns:
+        number of rendering processes that wrote each image
+    """
+
+    from multiprocessing import Process
+
+    create_job(job_dir, num_images, chunk_size, lease_secs=lease_secs)
+    os.makedirs(os.path.join(job_dir, 'out'))
+
+    crashers = [Process(target=_simulated_crash, args=(job_dir, f'crash{k}', render_secs)) for k in range(num_crashes)]
+    for p in crashers:
+        p.start()
+        p.join()
+
+    workers = [Process(target=_simulated_worker, args=(job_dir, f'worker{k}', render_secs, lease_secs / 4)) for k in range(num_workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    renders = {}
+    for i in range(num_images):
+        path = os.path.join(job_dir, 'out', f'img{i}')
+        renders[i] = len(open(path).read().split()) if os.path.exists(path) else 0
+
+    return renders
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='BSSIG Job Status', add_help=True)
+
+    parser.add_argument(
+        'job_dir',
+        metavar='job-dir',
+        type=str,
+        help='Path to shared job directory.',
+        )
+
+    parser.add_argument(
+        '--simulate', 
+        type=int, 
+        default=None, 
+        help='If specified, create a job in job-dir and run it with this many local worker processes rendering dummy images, after some workers crash holding chunks.',
+        )
+
+    parser.add_argument('--num-images', type=int, default=100, help='Number of images in a simulated job.',)
+
+    parser.add_argument('--chunk-size', type=int, default=10, help='Number of images per chunk in a simulated job.',)
+
+    parser.add_argument('--lease-secs', type=float, default=2.0, help='Lease length in a simulated job.',)
+
+    parser.add_argument('--render-secs', type=float, default=0.01, help='Time to render each dummy image in a simulated job.',)
+
+    parser.add_argument('--num-crashes', type=int, default=1, help='Number of workers that crash holding a chunk in a simulated job.',)
+
+    return parser
+
+def print_status(job_dir:str):
+    job = load_job(job_dir)
+    gens = _lease_gens(job_dir)
+
+    print(f'{num_done(job_dir, job)}/{job["num_chunks"]} chunks done')
+    for chunk in range(job['num_chunks']):
+        if is_done(job_dir, chunk) or chunk not in gens:
+            continue
+        lease = _read_lease(job_dir, job, chunk, gens[chunk])
+        if lease is not None:
+            state = 'expired' if lease['expires'] <= time.time() else f'{lease["expires"] - time.time():.0f}s left'
+            print(f'chunk {chunk}: leased by {lease["worker"]} (lease {gens[chunk]}, {state})')
+
+def main():
+    parser = get_args_parser()
+
+    args = parser.parse_args()
+
+    if args.simulate is not None:
+        renders = simulate(
+            args.job_dir, 
+            args.simulate, 
+            num_images=args.num_images, 
+            chunk_size=args.chunk_size, 
+            lease_secs=args.lease_secs, 
+            render_secs=args.render_secs, 
+            num_crashes=args.num_crashes,
+            )
+        missing = [i for i, n in renders.items() if n == 0]
+        print(f'{len(renders) - len(missing)}/{len(renders)} images rendered, {sum(n > 1 for n in renders.values())} more than once')
+        if missing:
+            raise Exception(f'Images never rendered: {missing}')
+
+    print_status(args.job_dir)
+
+if __name__ == '__main__':
+    main()